@@ -1,15 +1,21 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import os
 import time
-from typing import Dict, Any, Optional
-
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import uuid
+from typing import Dict, Any, Optional, Union
+
+import msgspec
+import orjson
+import redis.asyncio as aioredis
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -20,11 +26,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# in-memory store
+# in-memory store; with Redis, only rooms that have sockets on this worker
 FILES: Dict[str, Dict[str, Any]] = {}
 
 LOCK_TIMEOUT = 60 * 10  # 10 mins
 
+XML_FLUSH_DELAY = 0.03  # coalesce xml updates within this window (seconds)
+
+SEND_QUEUE_SIZE = 32  # frames buffered per socket before it is resynced with a snapshot
+
+# optional Redis for running several workers; unset = single process, in-memory only
+REDIS_URL = os.environ.get("REDIS_URL")
+redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+RELAY_RETRY_DELAY = 1.0  # wait before resubscribing after a Redis failure (seconds)
+
+WORKER_ID = uuid.uuid4().hex  # tags this process's entries in the shared user lists
+USERS_TTL = 30  # seconds a worker's users stay listed without a heartbeat
+
+XML_EVENT_PREFIX = b'{"type":"xml","xml":'
+LOCK_EVENT_PREFIX = b'{"type":"lock",'
+USERS_STATE_PREFIX = b'{"type":"state","users":'
+UNLOCK_EVENT = b'{"type":"unlock"}'
+
+# take the lock and announce it in one step; returns the current holder if taken
+LUA_LOCK = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+    redis.call("publish", ARGV[3], ARGV[4])
+    return false
+end
+return redis.call("get", KEYS[1])
+"""
+
+# delete and announce the lock only if it is still held by the caller
+LUA_UNLOCK = """
+local lock = redis.call("get", KEYS[1])
+if lock and cjson.decode(lock)["by"] == ARGV[1] then
+    redis.call("del", KEYS[1])
+    redis.call("publish", ARGV[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+
 # blank BPMN XML template for new files
 BLANK_BPMN_XML = """<?xml version="1.0" encoding="UTF-8"?>
 <bpmn:definitions xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
@@ -41,6 +85,9 @@ BLANK_BPMN_XML = """<?xml version="1.0" encoding="UTF-8"?>
 </bpmn:definitions>
 """
 
+# encoded once so new rooms start with their bytes and JSON fragment ready
+BLANK_BPMN_XML_BYTES = BLANK_BPMN_XML.encode("utf-8")
+BLANK_BPMN_XML_JSON = orjson.dumps(BLANK_BPMN_XML)
 
 
 class FilePayload(BaseModel):
@@ -52,164 +99,649 @@ class SavePayload(BaseModel):
     xml: str
 
 
+class MsgIn(msgspec.Struct):
+    """Inbound websocket message"""
+    type: str
+    user: Optional[str] = None
+    xml: Optional[str] = None
+    element: Optional[str] = None
+
+
+MSG_DECODER = msgspec.json.Decoder(MsgIn)
+
+
+# validators built once at import and reused for every request body
+FILE_PAYLOAD = TypeAdapter(FilePayload)
+SAVE_PAYLOAD = TypeAdapter(SavePayload)
+
+
+def json_body(adapter: TypeAdapter) -> Dict[str, Any]:
+    """OpenAPI request body for routes that parse the raw body themselves"""
+    return {"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": adapter.json_schema()}},
+    }}
+
+
+async def parse_body(request: Request, adapter: TypeAdapter) -> Any:
+    """Validate the raw JSON body in one pass, failing like FastAPI's own body parsing"""
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
+
+
+def new_room(xml: Optional[str] = None) -> Dict[str, Any]:
+    """Fresh room state; without xml it starts from the blank diagram"""
+    return {
+        "xml": xml.encode("utf-8") if xml else BLANK_BPMN_XML_BYTES,
+        "xml_json": orjson.dumps(xml) if xml else BLANK_BPMN_XML_JSON,
+        "lock": None,
+        "lock_deadline": 0.0,  # event-loop clock; in-memory lock expiry only
+        "users": set(),
+        "local_users": {},  # username -> open connections on this worker
+        "focus": {},
+        "sockets": {},  # id(ws) -> that socket's send queue
+        "state_cache": None,
+        "lock_denied": None,
+        "resync": set(),  # send queues owed a full snapshot in place of their next frame
+        "pending_xml": None,
+        "pending_by": None,
+        "flush_task": None,
+        "relay": None,
+        "relay_ready": None,
+        "heartbeat": None,
+        "joining": 0,  # sockets between load_room and registering in "sockets"
+    }
+
+
+def invalidate_state(room: Dict[str, Any]):
+    room["state_cache"] = None
+
+
+def full_state(room: Dict[str, Any]) -> bytes:
+    """Full state snapshot, cached until the room changes; xml is spliced in pre-encoded"""
+    if room["state_cache"] is None:
+        room["state_cache"] = (
+            b'{"type":"state","xml":' + room["xml_json"]
+            + b',"lock":' + orjson.dumps(room["lock"])
+            + b',"users":' + orjson.dumps(list(room["users"]))
+            + b',"focus":' + orjson.dumps(room["focus"]) + b'}'
+        )
+    return room["state_cache"]
+
+
+def users_state(room: Dict[str, Any]) -> bytes:
+    """State delta for a changed user list, the only field sent as a delta"""
+    return USERS_STATE_PREFIX + orjson.dumps(list(room["users"])) + b'}'
+
+
+def set_xml(room: Dict[str, Any], xml: str) -> bool:
+    """Replace the room xml (kept as UTF-8 bytes) and its pre-encoded JSON string.
+
+    Returns False, changing nothing, when the xml is identical to the current one.
+    """
+    data = xml.encode("utf-8")
+    if data == room["xml"]:
+        return False
+    room["xml"] = data
+    room["xml_json"] = orjson.dumps(xml)
+    invalidate_state(room)
+    return True
+
+
+def room_channel(file_id: str) -> str:
+    return f"room:{file_id}"
+
+
+def xml_key(file_id: str) -> str:
+    return f"room:{file_id}:xml"
+
+
+def lock_key(file_id: str) -> str:
+    return f"room:{file_id}:lock"
+
+
+def users_key(file_id: str) -> str:
+    return f"room:{file_id}:users"  # "worker:username" scored by expiry, across workers
+
+
+async def persist_xml(file_id: str, xml: bytes, event: bytes):
+    """Store the xml and broadcast its event; with Redis both go in one MULTI so
+    every worker receives the writes in the order they were stored"""
+    if redis is not None:
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.set(xml_key(file_id), xml).publish(room_channel(file_id), event).execute()
+    else:
+        await send_local(file_id, event)
+
+
+def set_lock(room: Dict[str, Any], lock: Optional[Dict[str, Any]]):
+    """Replace the room lock and drop the frames encoded from it"""
+    room["lock"] = lock
+    room["lock_denied"] = None
+    invalidate_state(room)
+
+
+def lock_denied_frame(room: Dict[str, Any]) -> bytes:
+    """Reply for a refused lock, encoded once per lock change"""
+    if room["lock_denied"] is None:
+        room["lock_denied"] = orjson.dumps({"type": "lock-denied", "lock": room["lock"]})
+    return room["lock_denied"]
+
+
+async def acquire_lock(room: Dict[str, Any], file_id: str, username: Optional[str]) -> bool:
+    """Take the file lock and announce it; with Redis it is shared by all workers
+    and expires on its own"""
+    now = asyncio.get_running_loop().time()
+    # "since" stays wall-clock for clients; expiry uses the monotonic loop clock
+    lock = {"by": username, "since": time.time()}
+    event = orjson.dumps({"type": "lock", **lock})
+
+    if redis is not None:
+        stored = await redis.eval(LUA_LOCK, 1, lock_key(file_id), orjson.dumps(lock),
+                                  LOCK_TIMEOUT, room_channel(file_id), event)
+        if stored is not None:
+            held = orjson.loads(stored)
+            if held != room["lock"]:  # keep the cached denial unless the holder changed
+                set_lock(room, held)
+            return False
+    elif room["lock"] is not None and now < room["lock_deadline"]:
+        return False
+
+    set_lock(room, lock)
+    room["lock_deadline"] = now + LOCK_TIMEOUT
+    if redis is None:
+        await send_local(file_id, event)
+    return True
+
+
+async def release_lock(room: Dict[str, Any], file_id: str, username: Optional[str]) -> bool:
+    """Drop the lock if the user holds it and announce the unlock"""
+    if redis is not None:
+        released = username is not None and await redis.eval(
+            LUA_UNLOCK, 1, lock_key(file_id), username, room_channel(file_id), UNLOCK_EVENT)
+    else:
+        released = room["lock"] is not None and room["lock"]["by"] == username
+
+    if not released:
+        return False
+    set_lock(room, None)
+    if redis is None:
+        await send_local(file_id, UNLOCK_EVENT)
+    return True
+
+
+async def touch_users(file_id: str, usernames):
+    """List these users as connected through this worker for another USERS_TTL"""
+    expires = time.time() + USERS_TTL
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zadd(users_key(file_id), {f"{WORKER_ID}:{user}": expires for user in usernames})
+        pipe.expire(users_key(file_id), USERS_TTL)
+        await pipe.execute()
+
+
+async def fetch_users(file_id: str) -> set:
+    """Users connected on any worker, dropping entries of workers that stopped heartbeating"""
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(users_key(file_id), "-inf", time.time())
+        pipe.zrange(users_key(file_id), 0, -1)
+        _, members = await pipe.execute()
+    return {member.decode("utf-8").split(":", 1)[1] for member in members}
+
+
+def set_users(room: Dict[str, Any], users: set) -> bool:
+    """Replace the user list; returns whether it changed (and needs a users delta)"""
+    if users == room["users"]:
+        return False
+    room["users"] = users
+    invalidate_state(room)
+    return True
+
+
+async def add_user(room: Dict[str, Any], file_id: str, username: str) -> bool:
+    count = room["local_users"].get(username, 0)
+    room["local_users"][username] = count + 1
+    if redis is not None:
+        if not count:
+            await touch_users(file_id, [username])
+        return set_users(room, await fetch_users(file_id))
+    return set_users(room, room["users"] | {username})
+
+
+async def remove_user(room: Dict[str, Any], file_id: str, username: str) -> bool:
+    count = room["local_users"].get(username, 0)
+    if count > 1:
+        room["local_users"][username] = count - 1
+        return False
+    if not count:
+        return False
+
+    del room["local_users"][username]
+    if redis is not None:
+        await redis.zrem(users_key(file_id), f"{WORKER_ID}:{username}")
+        return set_users(room, await fetch_users(file_id))
+    return set_users(room, room["users"] - {username})
+
+
+async def load_room(file_id: str) -> Dict[str, Any]:
+    """Return the local room for a websocket, creating it (and the file) if needed"""
+    room = FILES.get(file_id)
+    if room is not None:
+        return room
+
+    if redis is not None:
+        # the xml itself is loaded by the relay once it has subscribed
+        await redis.set(xml_key(file_id), BLANK_BPMN_XML_BYTES, nx=True)
+    return FILES.setdefault(file_id, new_room())
+
+
+async def refresh_room(room: Dict[str, Any], file_id: str):
+    """Reload xml, lock and users from Redis, covering anything published while unsubscribed"""
+    xml, lock = await redis.mget(xml_key(file_id), lock_key(file_id))
+    if xml is not None:
+        set_xml(room, xml.decode("utf-8"))
+    lock = orjson.loads(lock) if lock else None
+    if lock != room["lock"]:
+        set_lock(room, lock)
+    if room["local_users"]:  # our entries may have expired while Redis was unreachable
+        await touch_users(file_id, room["local_users"])
+    set_users(room, await fetch_users(file_id))
+    invalidate_state(room)
+
 
 @app.get("/files")
 async def list_files():
     """Return list of file IDs"""
-    return list(FILES.keys())
+    if redis is None:
+        return ORJSONResponse(list(FILES.keys()))
 
+    ids = dict.fromkeys(FILES)
+    async for key in redis.scan_iter(match=xml_key("*")):
+        ids[key.decode("utf-8")[len("room:"):-len(":xml")]] = None
+    return ORJSONResponse(list(ids))
 
-@app.post("/files")
-async def create_file(payload: FilePayload):
+
+@app.post("/files", openapi_extra=json_body(FILE_PAYLOAD))
+async def create_file(request: Request):
+    payload = await parse_body(request, FILE_PAYLOAD)
     fid = payload.name.strip()
     if not fid:
-        return JSONResponse({"error": "Name cannot be empty"}, status_code=400)
+        return ORJSONResponse({"error": "Name cannot be empty"}, status_code=400)
     if fid in FILES:
-        return JSONResponse({"error": "File already exists"}, status_code=409)
+        return ORJSONResponse({"error": "File already exists"}, status_code=409)
 
-    FILES[fid] = {
-        "xml": payload.xml or BLANK_BPMN_XML,
-        "lock": None,
-        "users": set(),
-        "focus": {},
-        "sockets": set(),
-    }
-    return {"ok": True, "id": fid}
+    room = new_room(payload.xml)
+    if redis is not None:
+        if not await redis.set(xml_key(fid), room["xml"], nx=True):
+            return ORJSONResponse({"error": "File already exists"}, status_code=409)
+    else:
+        FILES[fid] = room
+    return ORJSONResponse({"ok": True, "id": fid})
 
 
 @app.get("/files/{file_id}")
 async def get_file(file_id: str):
+    if redis is not None:
+        # Redis is authoritative; a local room may not be subscribed to updates
+        xml, lock = await redis.mget(xml_key(file_id), lock_key(file_id))
+        if xml is None:
+            return ORJSONResponse({"error": "File not found"}, status_code=404)
+        xml_json, lock_json = orjson.dumps(xml.decode("utf-8")), lock or b"null"
+    else:
+        room = FILES.get(file_id)
+        if not room:
+            return ORJSONResponse({"error": "File not found"}, status_code=404)
+        # ship the cached xml fragment as-is instead of decoding and re-encoding it
+        xml_json, lock_json = room["xml_json"], orjson.dumps(room["lock"])
+
+    return Response(
+        b'{"id":' + orjson.dumps(file_id) + b',"xml":' + xml_json + b',"lock":' + lock_json + b'}',
+        media_type="application/json",
+    )
+
+
+@app.put("/files/{file_id}", openapi_extra=json_body(SAVE_PAYLOAD))
+async def save_file(file_id: str, request: Request):
+    payload = await parse_body(request, SAVE_PAYLOAD)
     room = FILES.get(file_id)
-    if not room:
-        return JSONResponse({"error": "File not found"}, status_code=404)
+    if room is None:
+        if redis is None or not await redis.exists(xml_key(file_id)):
+            return ORJSONResponse({"error": "File not found"}, status_code=404)
+        # no sockets on this worker: the document only lives in Redis
+        await persist_xml(file_id, payload.xml.encode("utf-8"), xml_event(orjson.dumps(payload.xml), None))
+        return ORJSONResponse({"ok": True})
 
-    return {"id": file_id, "xml": room["xml"], "lock": room["lock"]}
+    # connected editors (and other workers) get the save like any live edit
+    if set_xml(room, payload.xml):
+        await persist_xml(file_id, room["xml"], xml_event(room["xml_json"], None))
+    return ORJSONResponse({"ok": True})
 
 
-@app.put("/files/{file_id}")
-async def save_file(file_id: str, payload: SavePayload):
-    room = FILES.get(file_id)
-    if not room:
-        return JSONResponse({"error": "File not found"}, status_code=404)
-
-    room["xml"] = payload.xml
-    return {"ok": True}
+#Helper Broadcast Functions
+def xml_event(xml_json: bytes, by: Optional[str]) -> bytes:
+    return XML_EVENT_PREFIX + xml_json + b',"by":' + orjson.dumps(by) + b'}'
 
 
-#Helper Broadcast Functions
 async def broadcast(file_id: str, message: Dict[str, Any]):
     room = FILES.get(file_id)
     if not room:
         return
 
-    text = json.dumps(message)
-    dead_sockets = []
+    await broadcast_bytes(file_id, orjson.dumps(message))
 
-    for ws in list(room["sockets"]):
-        try:
-            await ws.send_text(text)
-        except Exception:
-            dead_sockets.append(ws)
 
-    for ws in dead_sockets:
-        room["sockets"].discard(ws)
+async def broadcast_bytes(file_id: str, payload: bytes):
+    """Deliver to every socket in the room, across all workers when Redis is on"""
+    if redis is not None:
+        await redis.publish(room_channel(file_id), payload)
+    else:
+        await send_local(file_id, payload)
+
+
+def enqueue(room: Dict[str, Any], queue: asyncio.Queue, payload: bytes):
+    """Queue a frame without waiting.
+
+    Deltas and one-off events can't be dropped individually without the client
+    drifting, so a full queue is replaced by one full snapshot, which already
+    reflects this payload since rooms are updated before anything is sent.
+    A queue owed a snapshot gets it in place of this payload for the same reason.
+    """
+    if queue in room["resync"]:
+        room["resync"].discard(queue)
+        payload = full_state(room)
+    try:
+        queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(full_state(room))
+
 
+def send_to(room: Dict[str, Any], websocket: WebSocket, payload: bytes):
+    queue = room["sockets"].get(id(websocket))
+    if queue is not None:
+        enqueue(room, queue, payload)
 
-async def push_state(file_id: str):
+
+async def send_local(file_id: str, payload: bytes):
     room = FILES.get(file_id)
     if not room:
         return
 
-    await broadcast(file_id, {
-        "type": "state",
-        "xml": room["xml"],
-        "lock": room["lock"],
-        "users": list(room["users"]),
-        "focus": room["focus"],
-    })
+    # enqueue never awaits, so the dict cannot change mid-loop and needs no copy;
+    # every queue holds a reference to the same encoded payload
+    for queue in room["sockets"].values():
+        enqueue(room, queue, payload)
+
+
+async def socket_writer(websocket: WebSocket, queue: asyncio.Queue):
+    """Drain one socket's queue so a slow client never stalls the rest of the room"""
+    try:
+        while True:
+            await websocket.send_bytes(await queue.get())
+    except Exception:
+        pass  # connection gone; the receive loop cleans up
+
+
+async def push_users(room: Dict[str, Any], file_id: str):
+    """Broadcast the changed user list; clients merge it into their copy"""
+    await broadcast_bytes(file_id, users_state(room))
+
+
+async def flush_xml(room: Dict[str, Any], file_id: str):
+    """Apply the latest pending xml after a short delay and broadcast it once"""
+    try:
+        await asyncio.sleep(XML_FLUSH_DELAY)
+    finally:
+        # cleared before any further await so an edit arriving while we persist
+        # or publish schedules its own flush instead of being left pending
+        room["flush_task"] = None
+
+    xml, by = room["pending_xml"], room["pending_by"]
+    room["pending_xml"] = None
+    room["pending_by"] = None
+    # identical writes (autosave, echoes) are dropped without a broadcast
+    if xml is None or not set_xml(room, xml):
+        return
+
+    await persist_xml(file_id, room["xml"], xml_event(room["xml_json"], by))
+
+
+def schedule_xml(room: Dict[str, Any], file_id: str, xml: str, by: Optional[str]):
+    room["pending_xml"] = xml
+    room["pending_by"] = by
+    if room["flush_task"] is None:
+        room["flush_task"] = asyncio.create_task(flush_xml(room, file_id))
+
+
+def mirror_event(room: Dict[str, Any], payload: bytes):
+    """Apply xml/lock/users changes made on other workers so our state frames stay current"""
+    if payload.startswith(XML_EVENT_PREFIX):
+        # slice the pre-encoded fragment out rather than parsing the whole event;
+        # our own events (and repeats) match the current fragment and stop here
+        xml_json = payload[len(XML_EVENT_PREFIX):payload.rindex(b',"by":')]
+        if xml_json != room["xml_json"]:
+            room["xml"] = orjson.loads(xml_json).encode("utf-8")
+            room["xml_json"] = xml_json
+            invalidate_state(room)
+    elif payload.startswith(LOCK_EVENT_PREFIX):
+        event = orjson.loads(payload)
+        set_lock(room, {"by": event["by"], "since": event["since"]})
+    elif payload == UNLOCK_EVENT and room["lock"] is not None:
+        set_lock(room, None)
+    elif payload.startswith(USERS_STATE_PREFIX):
+        set_users(room, set(orjson.loads(payload)["users"]))
+
+
+async def relay_room(room: Dict[str, Any], file_id: str, ready: asyncio.Event):
+    """Forward this room's Redis channel to the sockets connected to this worker.
+
+    If Redis drops the connection it resubscribes, reloads the room and resends
+    the full snapshot so local clients catch up on whatever they missed.
+    """
+    reconnecting = False
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(room_channel(file_id))
+            await refresh_room(room, file_id)
+            if reconnecting:
+                await send_local(file_id, full_state(room))
+            ready.set()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                payload = message["data"]
+                mirror_event(room, payload)
+                await send_local(file_id, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            reconnecting = True
+            ready.set()  # don't hold up connecting sockets while Redis is down
+            await asyncio.sleep(RELAY_RETRY_DELAY)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+async def keep_users(room: Dict[str, Any], file_id: str):
+    """Keep this worker's users listed, and notice users whose worker went away
+    without removing them (crash, restart) once their entries expire"""
+    while True:
+        await asyncio.sleep(USERS_TTL / 3)
+        try:
+            if room["local_users"]:
+                await touch_users(file_id, room["local_users"])
+            if set_users(room, await fetch_users(file_id)):
+                await push_users(room, file_id)
+        except Exception:
+            pass  # Redis down; the relay reloads the room once it is back
+
+
+async def start_relay(room: Dict[str, Any], file_id: str):
+    """Subscribe this worker to the room channel and wait until it is up to date"""
+    if redis is None:
+        return
+    if room["relay"] is None:
+        room["relay_ready"] = asyncio.Event()
+        room["relay"] = asyncio.create_task(relay_room(room, file_id, room["relay_ready"]))
+        room["heartbeat"] = asyncio.create_task(keep_users(room, file_id))
+    await room["relay_ready"].wait()
+
+
+def stop_relay(room: Dict[str, Any], file_id: str):
+    """Unsubscribe once the last local socket leaves and forget the local copy,
+    which would otherwise go stale; the next socket reloads it from Redis"""
+    if room["relay"] is not None and not room["sockets"] and not room["joining"]:
+        room["relay"].cancel()
+        room["heartbeat"].cancel()
+        room["relay"] = None
+        room["relay_ready"] = None
+        room["heartbeat"] = None
+        if FILES.get(file_id) is room:
+            del FILES[file_id]
+
+
+async def leave_room(room: Dict[str, Any], file_id: str, username: Optional[str]):
+    """Drop a disconnected socket's user and lock, then the room if it was the last one"""
+    try:
+        if username is not None and await remove_user(room, file_id, username):
+            await push_users(room, file_id)
+        await release_lock(room, file_id, username)
+    finally:
+        stop_relay(room, file_id)
+
+
+async def receive_raw(websocket: WebSocket) -> Union[bytes, str]:
+    """Receive one frame, accepting both binary and text (older clients)"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    raw = message.get("bytes")
+    return raw if raw is not None else message["text"]
+
+
+#WebSocket op handlers: each returns the (possibly updated) username
+async def on_join(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                  username: Optional[str], msg: MsgIn) -> Optional[str]:
+    user = msg.user or "anon"
+    changed = False
+    if user != username:
+        if username is not None:
+            changed = await remove_user(room, file_id, username)
+        changed = await add_user(room, file_id, user) or changed
+        username = user
+
+    if changed:
+        # the delta reaches this socket too; it gets the full snapshot in its place
+        room["resync"].add(room["sockets"][id(websocket)])
+        await push_users(room, file_id)
+    else:
+        send_to(room, websocket, full_state(room))
+    return username
+
+
+async def on_lock(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                  username: Optional[str], msg: MsgIn) -> Optional[str]:
+    if not await acquire_lock(room, file_id, username):
+        send_to(room, websocket, lock_denied_frame(room))
+    return username
+
+
+async def on_unlock(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                    username: Optional[str], msg: MsgIn) -> Optional[str]:
+    await release_lock(room, file_id, username)
+    return username
+
+
+async def on_xml(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                 username: Optional[str], msg: MsgIn) -> Optional[str]:
+    # allow live XML updates for all users (even if unlocked);
+    # bursts are coalesced into one broadcast per XML_FLUSH_DELAY
+    if msg.xml is not None:
+        schedule_xml(room, file_id, msg.xml, username)
+    return username
+
+
+async def on_focus(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                   username: Optional[str], msg: MsgIn) -> Optional[str]:
+    elem = msg.element
+    if elem:
+        room["focus"][elem] = username
+        invalidate_state(room)
+        await broadcast(file_id, {"type": "focus", "element": elem, "user": username})
+    return username
+
+
+async def on_blur(websocket: WebSocket, room: Dict[str, Any], file_id: str,
+                  username: Optional[str], msg: MsgIn) -> Optional[str]:
+    elem = msg.element
+    if elem in room["focus"]:
+        del room["focus"][elem]
+        invalidate_state(room)
+        await broadcast(file_id, {"type": "blur", "element": elem})
+    return username
+
+
+HANDLERS = {
+    "join": on_join,
+    "lock": on_lock,
+    "unlock": on_unlock,
+    "xml": on_xml,
+    "focus": on_focus,
+    "blur": on_blur,
+}
 
 #WebSocket Endpoint
 @app.websocket("/ws/{file_id}")
 async def websocket_endpoint(websocket: WebSocket, file_id: str):
-    await websocket.accept()
-
-    # ensure file exists
-    if file_id not in FILES:
-        FILES[file_id] = {
-            "xml": BLANK_BPMN_XML,
-            "lock": None,
-            "users": set(),
-            "focus": {},
-            "sockets": set(),
-        }
-
-    room = FILES[file_id]
-    room["sockets"].add(websocket)
+    # ensure file exists, and subscribe before accepting so no events are missed
+    room = await load_room(file_id)
+    # counted before the first await so a socket leaving meanwhile can't drop the room
+    room["joining"] += 1
+    try:
+        await start_relay(room, file_id)
+        await websocket.accept()
+    except BaseException:
+        room["joining"] -= 1
+        stop_relay(room, file_id)
+        raise
+    room["joining"] -= 1
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    room["sockets"][id(websocket)] = queue
+    writer = asyncio.create_task(socket_writer(websocket, queue))
     username = None
 
     try:
         while True:
-            raw = await websocket.receive_text()
-            data = json.loads(raw)
-            op = data.get("type")
-
-            if op == "join":
-                username = data.get("user") or "anon"
-                room["users"].add(username)
-                await push_state(file_id)
-
-            elif op == "lock":
-                now = time.time()
-                lock = room.get("lock")
-
-                if lock and (now - lock.get("since", now) > LOCK_TIMEOUT):
-                    room["lock"] = None
-
-                if room["lock"] is None:
-                    room["lock"] = {"by": username, "since": now}
-                    await broadcast(file_id, {"type": "lock", "by": username})
-                    await push_state(file_id)
-                else:
-                    await websocket.send_text(json.dumps({
-                        "type": "lock-denied",
-                        "lock": room["lock"],
-                    }))
-
-            elif op == "unlock":
-                if room["lock"] and room["lock"]["by"] == username:
-                    room["lock"] = None
-                    await broadcast(file_id, {"type": "unlock"})
-                    await push_state(file_id)
-
-            elif op == "xml":
-                # allow live XML updates for all users (even if unlocked)
-                room["xml"] = data["xml"]
-                await broadcast(file_id, {
-                    "type": "xml",
-                    "xml": room["xml"],
-                    "by": username
-                })
-
-            elif op == "focus":
-                elem = data.get("element")
-                if elem:
-                    room["focus"][elem] = username
-                    await push_state(file_id)
-
-            elif op == "blur":
-                elem = data.get("element")
-                if elem in room["focus"]:
-                    del room["focus"][elem]
-                    await push_state(file_id)
+            raw = await receive_raw(websocket)
+            try:
+                msg = MSG_DECODER.decode(raw)
+            except msgspec.DecodeError:
+                continue  # malformed, or not a message we understand
+            handler = HANDLERS.get(msg.type)
+            if handler:
+                username = await handler(websocket, room, file_id, username, msg)
 
     except WebSocketDisconnect:
         pass
     finally:
-        room["sockets"].discard(websocket)
-        if username in room["users"]:
-            room["users"].remove(username)
+        room["sockets"].pop(id(websocket), None)
+        room["resync"].discard(queue)
+        writer.cancel()
+        # shielded so the lock and user list are still released if we are cancelled
+        await asyncio.shield(leave_room(room, file_id, username))
+
 
-        if room["lock"] and room["lock"]["by"] == username:
-            room["lock"] = None
+if __name__ == "__main__":
+    import uvicorn
 
-        await push_state(file_id)
+    # "auto" picks uvloop and httptools when installed (uvloop is not on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto", ws="websockets")
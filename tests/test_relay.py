@@ -0,0 +1,233 @@
+"""Room and relay lifecycle across two workers sharing one (fake) Redis.
+
+Each test loads main.py twice as independent worker modules and drives
+websocket_endpoint with in-memory sockets on a single event loop.
+"""
+import asyncio
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+import fakeredis
+import orjson
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+
+
+def load_worker(name, server):
+    spec = importlib.util.spec_from_file_location(name, MAIN)
+    worker = importlib.util.module_from_spec(spec)
+    sys.modules[name] = worker  # pydantic resolves the string annotations through it
+    spec.loader.exec_module(worker)
+    worker.redis = fakeredis.FakeAsyncRedis(server=server)
+    worker.RELAY_RETRY_DELAY = 0.01
+    return worker
+
+
+def workers():
+    server = fakeredis.FakeServer()
+    return load_worker("worker_a", server), load_worker("worker_b", server)
+
+
+class FakeSocket:
+    """Just enough of starlette's WebSocket for websocket_endpoint"""
+
+    def __init__(self, accept_gate=None):
+        self.inbox = asyncio.Queue()
+        self.sent = []
+        self.accept_gate = accept_gate
+
+    async def accept(self):
+        if self.accept_gate is not None:
+            await self.accept_gate.wait()
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send_bytes(self, data):
+        self.sent.append(orjson.loads(data))
+
+    def push(self, msg):
+        self.inbox.put_nowait({"type": "websocket.receive", "bytes": orjson.dumps(msg)})
+
+    def disconnect(self):
+        self.inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+
+def connect(worker, file_id, socket):
+    return asyncio.create_task(worker.websocket_endpoint(socket, file_id))
+
+
+async def until(check, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_edits_and_users_reach_the_other_worker():
+    async def scenario():
+        a, b = workers()
+        s1, s2 = FakeSocket(), FakeSocket()
+        t1, t2 = connect(a, "f", s1), connect(b, "f", s2)
+        s1.push({"type": "join", "user": "u1"})
+        await until(lambda: "f" in a.FILES and "f" in b.FILES)
+        s2.push({"type": "join", "user": "u2"})
+        await until(lambda: a.FILES["f"]["users"] == {"u1", "u2"} == b.FILES["f"]["users"])
+
+        s1.push({"type": "xml", "xml": "<edit/>"})
+        await until(lambda: {"type": "xml", "xml": "<edit/>", "by": "u1"} in s2.sent)
+        assert b.FILES["f"]["xml"] == b"<edit/>"
+
+        s1.push({"type": "lock"})
+        await until(lambda: b.FILES["f"]["lock"] is not None)
+        s1.disconnect()
+        await t1
+        await until(lambda: {"type": "unlock"} in s2.sent)
+        await until(lambda: b.FILES["f"]["users"] == {"u2"})
+        assert b.FILES["f"]["lock"] is None
+
+        s2.disconnect()
+        await t2
+
+    asyncio.run(scenario())
+
+
+def test_last_socket_leaving_drops_the_room_and_rejoin_reloads_it():
+    async def scenario():
+        a, b = workers()
+        s1 = FakeSocket()
+        t1 = connect(a, "f", s1)
+        s1.push({"type": "join", "user": "u1"})
+        await until(lambda: s1.sent)
+        room = a.FILES["f"]
+        s1.disconnect()
+        await t1
+        assert "f" not in a.FILES
+        assert room["relay"] is None and room["heartbeat"] is None
+
+        # saved elsewhere while worker a is not subscribed
+        await b.redis.set(b.xml_key("f"), b"<saved/>")
+
+        s2 = FakeSocket()
+        t2 = connect(a, "f", s2)
+        s2.push({"type": "join", "user": "u1"})
+        await until(lambda: s2.sent)
+        assert s2.sent[0]["xml"] == "<saved/>"
+        s2.disconnect()
+        await t2
+
+    asyncio.run(scenario())
+
+
+def test_socket_joining_while_the_last_one_leaves_keeps_the_room():
+    async def scenario():
+        a, b = workers()
+        s1 = FakeSocket()
+        t1 = connect(a, "f", s1)
+        await until(lambda: a.FILES.get("f") and a.FILES["f"]["sockets"])
+
+        gate = asyncio.Event()
+        s2 = FakeSocket(accept_gate=gate)
+        t2 = connect(a, "f", s2)
+        await asyncio.sleep(0.01)
+        s1.disconnect()
+        await t1
+        gate.set()
+        await until(lambda: a.FILES.get("f") and a.FILES["f"]["sockets"])
+        assert a.FILES["f"]["relay"] is not None
+
+        # still subscribed: edits from the other worker get through
+        s3 = FakeSocket()
+        t3 = connect(b, "f", s3)
+        s3.push({"type": "xml", "xml": "<b/>"})
+        await until(lambda: {"type": "xml", "xml": "<b/>", "by": None} in s2.sent)
+
+        s2.disconnect()
+        s3.disconnect()
+        await asyncio.gather(t2, t3)
+        assert "f" not in a.FILES and "f" not in b.FILES
+
+    asyncio.run(scenario())
+
+
+def test_relay_resyncs_sockets_after_losing_redis():
+    async def scenario():
+        a, b = workers()
+        subscribe = a.redis.pubsub
+        dropped = []
+
+        def flaky_pubsub():
+            pubsub = subscribe()
+            if not dropped:
+                dropped.append(pubsub)
+
+                async def listen():
+                    await until(lambda: len(dropped) > 1)  # let the test change things first
+                    raise ConnectionError("connection lost")
+                    yield
+                pubsub.listen = listen
+            return pubsub
+        a.redis.pubsub = flaky_pubsub
+
+        s1 = FakeSocket()
+        t1 = connect(a, "f", s1)
+        s1.push({"type": "join", "user": "u1"})
+        await until(lambda: "f" in a.FILES and a.FILES["f"]["users"] == {"u1"})
+        await b.redis.set(b.xml_key("f"), b"<missed/>")
+        dropped.append(None)
+
+        await until(lambda: s1.sent and s1.sent[-1].get("xml") == "<missed/>")
+        assert s1.sent[-1]["type"] == "state"
+        s1.disconnect()
+        await t1
+
+    asyncio.run(scenario())
+
+
+def test_users_of_a_worker_that_went_away_expire():
+    async def scenario():
+        a, b = workers()
+        a.USERS_TTL = 1
+        await a.redis.zadd(a.users_key("f"), {"gone:ghost": time.time() + 0.3})
+
+        s1 = FakeSocket()
+        t1 = connect(a, "f", s1)
+        s1.push({"type": "join", "user": "u1"})
+        await until(lambda: s1.sent)
+        assert set(s1.sent[0]["users"]) == {"u1", "ghost"}
+
+        await until(lambda: s1.sent[-1] == {"type": "state", "users": ["u1"]})
+        s1.disconnect()
+        await t1
+        assert await a.redis.zrange(a.users_key("f"), 0, -1) == []
+
+    asyncio.run(scenario())
+
+
+def test_joiner_gets_one_snapshot_and_others_a_users_delta():
+    async def scenario():
+        a, b = workers()
+        s1, s2, s3 = FakeSocket(), FakeSocket(), FakeSocket()
+        tasks = [connect(a, "f", s1), connect(a, "f", s2), connect(b, "f", s3)]
+        s1.push({"type": "join", "user": "u1"})
+        await until(lambda: s1.sent)
+        await until(lambda: s2.sent and s3.sent)
+        before = len(s2.sent)
+        s2.push({"type": "join", "user": "u2"})
+        await until(lambda: len(s3.sent) == 2)
+        await asyncio.sleep(0.05)
+
+        joined = s2.sent[before:]
+        assert len(joined) == 1
+        assert set(joined[0]["users"]) == {"u1", "u2"} and "xml" in joined[0]
+        for socket in (s1, s3):
+            assert set(socket.sent[-1].pop("users")) == {"u1", "u2"}
+            assert socket.sent[-1] == {"type": "state"}
+
+        for socket in (s1, s2, s3):
+            socket.disconnect()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())